@@ -4,100 +4,227 @@ Advanced Load Testing Script for Async/Await Demo
 Uses concurrent requests to demonstrate async vs sync performance differences
 """
 
-import requests
+import asyncio
+import aiohttp
+import multiprocessing
+import numpy as np
+import os
 import time
-import statistics
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import sys
+import urllib.request
+from yarl import URL
+
+try:
+    # libuv-backed event loop; falls back to the stdlib loop where unavailable (e.g. Windows)
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
+try:
+    # Optional GIL-contention sampler; the metric is only reported when installed
+    from gilknocker import KnockKnock
+except ImportError:
+    KnockKnock = None
 
 BASE_URL = "http://localhost:5000"
 CONCURRENT_REQUESTS = 100
 TOTAL_REQUESTS = 500
+WORKERS = os.cpu_count() or 1  # One load-generator process per core
+MAX_LATENCY_MS = 60_000  # Histogram cap; slower responses land in the last bucket
+
+# Completed-request counter shared with worker processes (set by _init_worker)
+_progress = None
+
+# Per-process event loop and HTTP session, reused by every shard a worker runs
+# so pooled keep-alive connections are not torn down between calls
+_loop = None
+_session = None
 
 def check_server():
     """Check if the server is running"""
     try:
-        response = requests.get(f"{BASE_URL}/metrics", timeout=5)
-        return response.status_code == 200
+        with urllib.request.urlopen(f"{BASE_URL}/metrics", timeout=5) as response:
+            return response.status == 200
     except:
         return False
 
 def reset_metrics():
     """Reset server metrics"""
     try:
-        requests.post(f"{BASE_URL}/metrics/reset", timeout=5)
+        request = urllib.request.Request(f"{BASE_URL}/metrics/reset", method="POST")
+        urllib.request.urlopen(request, timeout=5).close()
         print("✓ Metrics reset")
     except:
         print("✗ Failed to reset metrics")
 
-def make_request(url):
-    """Make a single request and measure response time"""
-    start = time.time()
+async def make_request(session, url):
+    """Make a single request and return (elapsed_ns, ok)"""
+    start = time.perf_counter_ns()
     try:
-        response = requests.get(url, timeout=30)
-        elapsed = (time.time() - start) * 1000  # Convert to milliseconds
-        return {
-            'success': response.status_code == 200,
-            'time': elapsed,
-            'status': response.status_code
-        }
-    except Exception as e:
-        elapsed = (time.time() - start) * 1000
-        return {
-            'success': False,
-            'time': elapsed,
-            'status': 'error',
-            'error': str(e)
-        }
-
-def run_load_test(endpoint, name, concurrent=CONCURRENT_REQUESTS, total=TOTAL_REQUESTS):
-    """Run load test on a specific endpoint"""
+        async with session.get(url) as response:
+            # Drain the body so the connection goes back to the pool for reuse
+            await response.read()
+        return time.perf_counter_ns() - start, response.status == 200
+    except Exception:
+        return time.perf_counter_ns() - start, False
+
+async def open_session(concurrent):
+    """Create the worker's session; `concurrent` is only an upper bound on its connections"""
+    # Idle connections must outlive the gap between phases (Kestrel keeps them for 130s)
+    connector = aiohttp.TCPConnector(limit=concurrent, limit_per_host=concurrent,
+                                     ttl_dns_cache=300, keepalive_timeout=120)
+    timeout = aiohttp.ClientTimeout(total=30)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+async def warm_up(session, connections):
+    """Open `connections` pooled connections with unmeasured requests to /metrics"""
+    url = URL(f"{BASE_URL}/metrics")
+    await asyncio.gather(*[make_request(session, url) for _ in range(connections)])
+
+async def run_worker_async(endpoint, n_requests, concurrent):
+    """Issue n_requests against an endpoint with at most `concurrent` in flight"""
+    # Parse the URL once; aiohttp would otherwise re-parse the string on every request
+    url = URL(f"{BASE_URL}{endpoint}")
+    # Fixed-size histogram of whole-millisecond latencies, independent of n_requests
+    hist = np.zeros(MAX_LATENCY_MS, dtype=np.int64)
+    latency_sum_ns = 0
+    errors = 0
+    remaining = n_requests
+    # Completions not yet added to the shared counter; publishing in batches keeps the
+    # cross-process lock out of the per-request path
+    unpublished = 0
+    last_publish = time.monotonic()
+
+    def publish_progress():
+        nonlocal unpublished, last_publish
+        with _progress.get_lock():
+            _progress.value += unpublished
+        unpublished = 0
+        last_publish = time.monotonic()
+
+    async def client_loop(session):
+        # Each client issues requests back to back until the shared budget is used up,
+        # so at most `concurrent` requests are ever in flight
+        nonlocal remaining, latency_sum_ns, errors, unpublished
+        while remaining > 0:
+            remaining -= 1
+            elapsed_ns, ok = await make_request(session, url)
+
+            # Collect results as they complete
+            hist[min(elapsed_ns // 1_000_000, MAX_LATENCY_MS - 1)] += 1
+            latency_sum_ns += elapsed_ns
+            errors += not ok
+
+            unpublished += 1
+            if time.monotonic() - last_publish >= 0.1:
+                publish_progress()
+
+    session = _session
+    knocker = KnockKnock(polling_interval_micros=1000) if KnockKnock else None
+    if knocker:
+        knocker.start()
+
+    # Monotonic, system-wide clock, so windows from different workers can be compared
+    start_time = time.monotonic()
+    await asyncio.gather(*[client_loop(session) for _ in range(min(concurrent, n_requests))])
+    end_time = time.monotonic()
+    publish_progress()
+
+    contention = None
+    if knocker:
+        knocker.stop()
+        contention = knocker.contention_metric
+
+    return hist, latency_sum_ns, errors, contention, start_time, end_time
+
+def _init_worker(progress, concurrent, ready):
+    """Set up the worker's progress counter, event loop and warmed-up session"""
+    global _progress, _loop, _session
+    _progress = progress
+    _loop = asyncio.new_event_loop()
+    # Sized once for the whole run: shards get uneven concurrency shares, and rebuilding
+    # per shard would drop warm connections depending on which worker picked which shard
+    _session = _loop.run_until_complete(open_session(concurrent))
+    # Every phase then starts on already-open connections, not just the ones after the first
+    share = -(-concurrent // min(WORKERS, concurrent))
+    _loop.run_until_complete(warm_up(_session, share))
+    ready.wait()
+
+def _worker(endpoint, n_requests, concurrent_per_worker):
+    """Worker process entry point: run one shard of the load test on the worker's event loop"""
+    return _loop.run_until_complete(run_worker_async(endpoint, n_requests, concurrent_per_worker))
+
+def _split(n, parts):
+    """Split n into `parts` near-equal integer shares"""
+    return [n // parts + (1 if i < n % parts else 0) for i in range(parts)]
+
+def run_load_test(pool, progress, endpoint, name, concurrent=CONCURRENT_REQUESTS, total=TOTAL_REQUESTS):
+    """Run load test on a specific endpoint using the shared worker pool"""
     print(f"\n{'='*60}")
     print(f"Testing: {name}")
     print(f"Endpoint: {endpoint}")
     print(f"Concurrent: {concurrent} | Total Requests: {total}")
     print(f"{'='*60}")
 
-    url = f"{BASE_URL}{endpoint}"
-    results = []
+    # Shard the requests across the pool's processes so the client itself
+    # is not limited by a single GIL
+    workers = max(1, min(WORKERS, concurrent, total))
+    shards = list(zip([endpoint] * workers, _split(total, workers), _split(concurrent, workers)))
+
+    progress.value = 0
+    pending = pool.starmap_async(_worker, shards)
+
+    # Redraw a single progress line at most every 200ms instead of printing per batch
+    last_print = 0.0
+    while not pending.ready():
+        pending.wait(0.2)
+        now = time.monotonic()
+        if now - last_print >= 0.2:
+            sys.stdout.write(f"\r  Progress: {progress.value}/{total} requests completed")
+            sys.stdout.flush()
+            last_print = now
+
+    worker_results = pending.get()
+    sys.stdout.write(f"\r  Progress: {total}/{total} requests completed\n")
+
+    # Merge the per-worker histograms into one preallocated histogram, adding in place
+    # rather than stacking copies, and measure wall time from first start to last finish
+    hist = np.zeros(MAX_LATENCY_MS, dtype=np.int64)
+    latency_sum_ns = 0
     errors = 0
-
-    start_time = time.time()
-
-    # Use ThreadPoolExecutor for concurrent requests
-    with ThreadPoolExecutor(max_workers=concurrent) as executor:
-        # Submit all requests
-        futures = [executor.submit(make_request, url) for _ in range(total)]
-
-        # Collect results as they complete
-        completed = 0
-        for future in as_completed(futures):
-            result = future.result()
-            results.append(result['time'])
-            if not result['success']:
-                errors += 1
-
-            completed += 1
-            if completed % 50 == 0:
-                print(f"  Progress: {completed}/{total} requests completed")
-
-    total_time = time.time() - start_time
+    contentions = []
+    first_start, last_end = float('inf'), 0.0
+    for shard_hist, shard_sum_ns, shard_errors, contention, start, end in worker_results:
+        np.add(hist, shard_hist, out=hist)
+        latency_sum_ns += shard_sum_ns
+        errors += shard_errors
+        if contention is not None:
+            contentions.append(contention)
+        first_start = min(first_start, start)
+        last_end = max(last_end, end)
+    total_time = last_end - first_start
+    n = int(hist.sum())
 
     # Calculate statistics
-    if results:
-        results.sort()
+    if n:
+        # Percentiles are read off the cumulative histogram: O(MAX_LATENCY_MS), no sort
+        p50, p95, p99 = np.searchsorted(np.cumsum(hist), [n * 0.50, n * 0.95, n * 0.99])
+        filled = np.flatnonzero(hist)
         stats = {
             'total_requests': total,
             'successful': total - errors,
             'failed': errors,
             'total_time_sec': round(total_time, 2),
             'requests_per_sec': round(total / total_time, 2),
-            'avg_response_ms': round(statistics.mean(results), 2),
-            'min_response_ms': round(min(results), 2),
-            'max_response_ms': round(max(results), 2),
-            'p50_ms': round(results[int(len(results) * 0.50)], 2),
-            'p95_ms': round(results[int(len(results) * 0.95)], 2),
-            'p99_ms': round(results[int(len(results) * 0.99)], 2),
+            'avg_response_ms': round(latency_sum_ns / n / 1_000_000, 2),
+            'min_response_ms': int(filled[0]),
+            'max_response_ms': int(filled[-1]),
+            'p50_ms': int(p50),
+            'p95_ms': int(p95),
+            'p99_ms': int(p99),
+            # Mean client-side GIL contention across workers (0-1), None without gilknocker
+            'gil_contention': round(sum(contentions) / len(contentions), 3) if contentions else None,
         }
 
         print(f"\n{'─'*60}")
@@ -108,6 +235,8 @@ def run_load_test(endpoint, name, concurrent=CONCURRENT_REQUESTS, total=TOTAL_RE
         print(f"  Failed:             {stats['failed']}")
         print(f"  Total Time:         {stats['total_time_sec']}s")
         print(f"  Throughput:         {stats['requests_per_sec']} req/sec")
+        if stats['gil_contention'] is not None:
+            print(f"  GIL Contention:     {stats['gil_contention']} (client)")
         print(f"\n  Response Times:")
         print(f"    Average:          {stats['avg_response_ms']} ms")
         print(f"    Min:              {stats['min_response_ms']} ms")
@@ -146,43 +275,59 @@ def main():
     # Store results for comparison
     all_results = {}
 
-    # Test ASYNC endpoints
-    print("\n" + "="*60)
-    print("PHASE 1: ASYNC ENDPOINTS")
-    print("="*60)
-
-    all_results['async_users'] = run_load_test(
-        "/api/async/users",
-        "ASYNC - Get Users",
-        concurrent=CONCURRENT_REQUESTS,
-        total=TOTAL_REQUESTS
-    )
-
-    all_results['async_orders'] = run_load_test(
-        "/api/async/orders/123",
-        "ASYNC - Get Orders",
-        concurrent=CONCURRENT_REQUESTS,
-        total=TOTAL_REQUESTS
-    )
-
-    # Test SYNC endpoints
-    print("\n" + "="*60)
-    print("PHASE 2: SYNC ENDPOINTS")
-    print("="*60)
-
-    all_results['sync_users'] = run_load_test(
-        "/api/sync/users",
-        "SYNC - Get Users",
-        concurrent=CONCURRENT_REQUESTS,
-        total=TOTAL_REQUESTS
-    )
-
-    all_results['sync_orders'] = run_load_test(
-        "/api/sync/orders/123",
-        "SYNC - Get Orders",
-        concurrent=CONCURRENT_REQUESTS,
-        total=TOTAL_REQUESTS
-    )
+    # Windows only supports spawn; elsewhere keep the platform default
+    ctx = multiprocessing.get_context("spawn" if sys.platform == "win32" else None)
+    progress = ctx.Value('q', 0)
+    ready = ctx.Barrier(WORKERS + 1)
+
+    # One worker pool serves all four phases, so processes, event loops and
+    # keep-alive connections stay warm between them
+    with ctx.Pool(processes=WORKERS, initializer=_init_worker,
+                  initargs=(progress, CONCURRENT_REQUESTS, ready)) as pool:
+        # Wait until every worker has warmed its connections
+        ready.wait()
+
+        # Test ASYNC endpoints
+        print("\n" + "="*60)
+        print("PHASE 1: ASYNC ENDPOINTS")
+        print("="*60)
+
+        all_results['async_users'] = run_load_test(
+            pool, progress,
+            "/api/async/users",
+            "ASYNC - Get Users",
+            concurrent=CONCURRENT_REQUESTS,
+            total=TOTAL_REQUESTS
+        )
+
+        all_results['async_orders'] = run_load_test(
+            pool, progress,
+            "/api/async/orders/123",
+            "ASYNC - Get Orders",
+            concurrent=CONCURRENT_REQUESTS,
+            total=TOTAL_REQUESTS
+        )
+
+        # Test SYNC endpoints
+        print("\n" + "="*60)
+        print("PHASE 2: SYNC ENDPOINTS")
+        print("="*60)
+
+        all_results['sync_users'] = run_load_test(
+            pool, progress,
+            "/api/sync/users",
+            "SYNC - Get Users",
+            concurrent=CONCURRENT_REQUESTS,
+            total=TOTAL_REQUESTS
+        )
+
+        all_results['sync_orders'] = run_load_test(
+            pool, progress,
+            "/api/sync/orders/123",
+            "SYNC - Get Orders",
+            concurrent=CONCURRENT_REQUESTS,
+            total=TOTAL_REQUESTS
+        )
 
     # Comparison
     print("\n" + "="*60)
@@ -194,29 +339,40 @@ def main():
         ('Orders Endpoint', 'async_orders', 'sync_orders')
     ]
 
-    for name, async_key, sync_key in comparisons:
-        if all_results.get(async_key) and all_results.get(sync_key):
-            async_stats = all_results[async_key]
-            sync_stats = all_results[sync_key]
-
-            print(f"\n{name}:")
-            print(f"  Throughput:")
-            print(f"    ASYNC: {async_stats['requests_per_sec']} req/sec")
-            print(f"    SYNC:  {sync_stats['requests_per_sec']} req/sec")
-            improvement = ((async_stats['requests_per_sec'] - sync_stats['requests_per_sec'])
-                          / sync_stats['requests_per_sec'] * 100)
-            print(f"    Improvement: {improvement:+.1f}%")
-
-            print(f"\n  Average Response Time:")
-            print(f"    ASYNC: {async_stats['avg_response_ms']} ms")
-            print(f"    SYNC:  {sync_stats['avg_response_ms']} ms")
-            improvement = ((sync_stats['avg_response_ms'] - async_stats['avg_response_ms'])
-                          / sync_stats['avg_response_ms'] * 100)
-            print(f"    Faster by: {improvement:+.1f}%")
-
-            print(f"\n  P95 Response Time:")
-            print(f"    ASYNC: {async_stats['p95_ms']} ms")
-            print(f"    SYNC:  {sync_stats['p95_ms']} ms")
+    rows = [(name, all_results[async_key], all_results[sync_key])
+            for name, async_key, sync_key in comparisons
+            if all_results.get(async_key) and all_results.get(sync_key)]
+
+    # Comparison array field -> key in the per-test stats dict
+    fields = {'rps': 'requests_per_sec', 'avg_ms': 'avg_response_ms', 'p95': 'p95_ms'}
+    dtype = [(field, np.float64) for field in fields]
+    async_arr = np.rec.fromrecords([tuple(a[key] for key in fields.values()) for _, a, _ in rows], dtype=dtype)
+    sync_arr = np.rec.fromrecords([tuple(s[key] for key in fields.values()) for _, _, s in rows], dtype=dtype)
+
+    # Improvements for every endpoint at once: higher throughput and lower latency are better
+    throughput_gain = (async_arr.rps - sync_arr.rps) / sync_arr.rps * 100
+    latency_gain = (sync_arr.avg_ms - async_arr.avg_ms) / sync_arr.avg_ms * 100
+    p95_gain = (sync_arr.p95 - async_arr.p95) / sync_arr.p95 * 100
+
+    for i, (name, async_stats, sync_stats) in enumerate(rows):
+        print(f"\n{name}:")
+        print(f"  Throughput:")
+        print(f"    ASYNC: {async_stats['requests_per_sec']} req/sec")
+        print(f"    SYNC:  {sync_stats['requests_per_sec']} req/sec")
+        print(f"    Improvement: {throughput_gain[i]:+.1f}%")
+        if async_stats['gil_contention'] is not None and sync_stats['gil_contention'] is not None:
+            print(f"    Client GIL contention: ASYNC {async_stats['gil_contention']}"
+                  f" | SYNC {sync_stats['gil_contention']}")
+
+        print(f"\n  Average Response Time:")
+        print(f"    ASYNC: {async_stats['avg_response_ms']} ms")
+        print(f"    SYNC:  {sync_stats['avg_response_ms']} ms")
+        print(f"    Faster by: {latency_gain[i]:+.1f}%")
+
+        print(f"\n  P95 Response Time:")
+        print(f"    ASYNC: {async_stats['p95_ms']} ms")
+        print(f"    SYNC:  {sync_stats['p95_ms']} ms")
+        print(f"    Faster by: {p95_gain[i]:+.1f}%")
 
     print("\n" + "="*60)
     print("KEY TAKEAWAYS:")